@@ -1,241 +1,433 @@
+import atexit
+import bisect
+import codecs
 import csv
+import io
+import mmap
 import os
+import pickle
+import threading
+import time
+from functools import wraps
+from dataclasses import dataclass
 from flask import Flask, jsonify, render_template, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
+try:
+    import orjson
+except ImportError:  # optional: fall back to Flask's stdlib json encoder
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes responses with the C-backed orjson."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize the Flask application
 app = Flask(__name__, static_folder='.', static_url_path='', template_folder='.')
 CORS(app)  # Enable Cross-Origin Resource Sharing
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 # --- Constants ---
 PLAYERS_CSV_FILE = 'players.csv'
+PLAYERS_PICKLE_FILE = 'players.pkl'  # binary snapshot of player rows for fast startup
 CSV_HEADERS = ['id', 'name', 'elo', 'wins', 'losses', 'is_playing']
+CSV_TRUE_VALUES = frozenset({'True', 'true', 'TRUE'})  # we write 'True'; the others cover hand edits
 STARTING_ELO = 1000
+WRITE_BUFFER_SIZE = 1 << 16  # bytes buffered before each write() syscall
+FLUSH_DELAY = 0.25  # seconds to coalesce player changes before writing the CSV
+FLUSH_RETRY_DELAY = 5  # seconds to wait before retrying a failed CSV write
+
+# --- Data Model ---
+@dataclass(slots=True)
+class Player:
+    """A player record; serialized to JSON field-by-field by the app's JSON provider."""
+    id: str
+    name: str
+    elo: int = STARTING_ELO
+    wins: int = 0
+    losses: int = 0
+    is_playing: bool = True
+
+    def as_row(self):
+        """Returns the player's fields as a plain tuple in CSV_HEADERS order."""
+        return (self.id, self.name, self.elo, self.wins, self.losses, self.is_playing)
+
+class _RowUnpickler(pickle.Unpickler):
+    """Unpickler for player snapshots, which only ever hold builtin tuples."""
+    def find_class(self, module, name):
+        # Refusing globals means loading a snapshot can never import this module a second time
+        raise pickle.UnpicklingError(f"unexpected global {module}.{name} in player snapshot")
 
 # --- State Management (in-memory) ---
 session_data = {
     "is_active": False,
     "players": {},
-    "waiting_ids": [],
-    "active_matches": [],
+    "waiting_queue": [],  # (-elo, id) pairs kept sorted, highest ELO first
+    "active_matches": {},  # match id -> match, in table order
     "max_tables": 0
 }
 
+# Authoritative player records keyed by id; players.csv is a write-through copy
+_players_cache = {}
+_next_id = 1  # id handed to the next added player; set from the cache by load_players
+_dirty = threading.Event()
+_flush_lock = threading.Lock()
+_rows_taken = 0  # number of row sets captured for flushing; guarded by _state_lock
+_rows_written = 0  # number of the last row set written to disk; guarded by _flush_lock
+_state_lock = threading.RLock()  # guards session_data and _players_cache across request threads
+_storage_ready = False  # set once init_storage has loaded players and started the flusher
+
 # --- Helper Functions ---
-def get_players_from_csv():
-    """Reads all players from the CSV file."""
-    if not os.path.exists(PLAYERS_CSV_FILE):
-        return []
+def read_players_csv():
+    """Reads all players from the CSV file. Errors other than a missing file are raised."""
+    # Never return [] for an unreadable file: the flusher would persist that empty roster over it
     try:
-        # FIX: Specify UTF-8 encoding with BOM support to handle files saved by different editors (like Excel)
-        with open(PLAYERS_CSV_FILE, 'r', newline='', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            players = []
-            for row in reader:
-                if row and 'elo' in row and row['elo'] is not None and row['elo'] != '':
-                    try:
-                        row['elo'] = int(float(row['elo']))
-                        row['wins'] = int(row['wins'])
-                        row['losses'] = int(row['losses'])
-                        row['is_playing'] = row['is_playing'].lower() == 'true'
-                        players.append(row)
-                    except (ValueError, KeyError) as e:
-                        print(f"Skipping malformed row: {row}. Error: {e}")
-            return players
-    except (IOError, csv.Error) as e:
-        print(f"Error reading CSV file: {e}")
+        # Map the file once and parse it from memory rather than through a buffered stream
+        with open(PLAYERS_CSV_FILE, 'rb') as raw:
+            if os.fstat(raw.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # FIX: Skip the UTF-8 BOM that editors like Excel add, then decode the rest as plain UTF-8
+                start = len(codecs.BOM_UTF8) if mm[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 else 0
+                text = mm[start:].decode('utf-8')
+    except FileNotFoundError:
         return []
 
-def write_players_to_csv(players):
-    """Writes a list of player dictionaries to the CSV file."""
+    with io.StringIO(text, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return []
+        missing = [h for h in CSV_HEADERS if h not in header]
+        if missing:
+            raise ValueError(f"{PLAYERS_CSV_FILE} is missing columns: {', '.join(missing)}")
+        i_id, i_name, i_elo, i_wins, i_losses, i_play = map(header.index, CSV_HEADERS)
+        players = []
+        for row in reader:
+            if not row:
+                continue
+            try:
+                players.append(Player(
+                    row[i_id],
+                    row[i_name],
+                    int(float(row[i_elo])),
+                    int(row[i_wins]),
+                    int(row[i_losses]),
+                    row[i_play] in CSV_TRUE_VALUES
+                ))
+            except (ValueError, IndexError) as e:
+                print(f"Skipping malformed row: {row}. Error: {e}")
+        return players
+
+def _csv_signature():
+    """Returns the CSV file's (mtime in ns, size), which a snapshot must match to be used."""
+    st = os.stat(PLAYERS_CSV_FILE)
+    return (st.st_mtime_ns, st.st_size)
+
+def read_players_pickle():
+    """Reads the player snapshot into an id -> Player dict if it was taken of the current CSV file, else None."""
     try:
-        with open(PLAYERS_CSV_FILE, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-            writer.writeheader()
-            players_to_write = [p.copy() for p in players]
-            for p in players_to_write:
-                p['is_playing'] = str(p['is_playing'])
-            writer.writerows(players_to_write)
-    except IOError as e:
-        print(f"Error writing to CSV file: {e}")
-
-def get_next_player_id(players):
+        with open(PLAYERS_PICKLE_FILE, 'rb') as f:
+            csv_signature, rows = _RowUnpickler(f).load()
+        # Compare exactly: an mtime-ordering check misses CSV edits made within one timestamp tick
+        if csv_signature != _csv_signature():
+            return None
+        return {row[0]: Player(*row) for row in rows}
+    except (OSError, pickle.UnpicklingError, EOFError, TypeError, ValueError, IndexError):
+        # Unreadable or older-format snapshots are ignored and rebuilt from the CSV
+        return None
+
+def write_players_pickle(rows, csv_signature):
+    """Writes a binary snapshot of player rows (see Player.as_row) for the CSV file with the given signature."""
+    tmp_file = PLAYERS_PICKLE_FILE + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            pickle.dump((csv_signature, rows), f, protocol=5)
+        os.replace(tmp_file, PLAYERS_PICKLE_FILE)
+    except (OSError, pickle.PicklingError) as e:
+        print(f"Error writing player snapshot: {e}")
+
+def load_players():
+    """Loads players into the in-memory cache, preferring an up-to-date snapshot."""
+    global _next_id
+    _players_cache.clear()
+    snapshot = read_players_pickle()
+    if snapshot is not None:
+        _players_cache.update(snapshot)
+    else:
+        csv_signature = _csv_signature()  # taken before reading, so a concurrent edit invalidates the snapshot
+        players = read_players_csv()  # raises on failure, so no snapshot of a bad read is written
+        for p in players:
+            _players_cache[p.id] = p
+        write_players_pickle([p.as_row() for p in players], csv_signature)
+    # Hand-edited rows may carry non-numeric ids; they can't collide with generated ones
+    _next_id = max((int(pid) for pid in _players_cache if pid.isdecimal()), default=0) + 1
+
+def get_players_from_csv():
+    """Returns all players from the in-memory cache."""
+    return list(_players_cache.values())
+
+def _schedule_write():
+    """Marks the player cache as changed so the flusher thread writes it out."""
+    _dirty.set()
+
+def flush_players():
+    """Writes the player cache to the CSV file if it has unsaved changes; returns False if the write failed."""
+    global _rows_taken, _rows_written
+    # Copy the rows under the state lock so a half-applied result can't reach disk,
+    # and release it before taking _flush_lock so the two locks are never nested the other way
+    with _state_lock:
+        # Before players are loaded the cache is empty, and flushing it would wipe the CSV
+        if not _storage_ready or not _dirty.is_set():
+            return True
+        _dirty.clear()
+        rows = [p.as_row() for p in _players_cache.values()]
+        _rows_taken += 1
+        taken = _rows_taken
+    with _flush_lock:
+        if taken < _rows_written:
+            return True  # a newer set of rows is already on disk
+        try:
+            write_players_to_csv(rows)
+        except Exception as e:
+            print(f"Error writing to CSV file: {e}")
+            _dirty.set()  # keep the changes pending so a later flush retries them
+            return False
+        write_players_pickle(rows, _csv_signature())
+        _rows_written = taken
+        return True
+
+def _flusher():
+    """Background loop that batches cache changes into a single CSV rewrite."""
+    while True:
+        _dirty.wait()
+        time.sleep(FLUSH_DELAY)
+        try:
+            flushed = flush_players()
+        except Exception as e:  # never let an unexpected error stop all further saves
+            print(f"Error flushing players: {e}")
+            _dirty.set()
+            flushed = False
+        if not flushed:
+            time.sleep(FLUSH_RETRY_DELAY)
+
+def start_flusher():
+    """Starts the background CSV writer and flushes once more on exit."""
+    threading.Thread(target=_flusher, name='csv-flusher', daemon=True).start()
+    atexit.register(flush_players)
+
+def write_players_to_csv(rows):
+    """Writes player rows (see Player.as_row) to the CSV file. Errors are raised to the caller."""
+    tmp_file = PLAYERS_CSV_FILE + '.tmp'
+    with open(tmp_file, 'w', newline='', encoding='utf-8-sig', buffering=WRITE_BUFFER_SIZE) as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADERS)
+        writer.writerows(rows)  # csv writes the is_playing bools as True/False
+    os.replace(tmp_file, PLAYERS_CSV_FILE)
+
+def get_next_player_id():
     """Generates a new unique player ID."""
-    if not players:
-        return "1"
-    return str(max(int(p['id']) for p in players) + 1)
+    global _next_id
+    player_id = str(_next_id)
+    _next_id += 1
+    return player_id
 
 # --- ELO Calculation Logic ---
-def calculate_new_ratings(winner_rating, loser_rating, winner_score, loser_score):
-    """Calculates ELO change based on a best-of-3 match result."""
+# Winner's expected score indexed by (loser_rating - winner_rating) + MAX_RATING_DIFF
+MAX_RATING_DIFF = 1200
+EXPECTED_SCORE = [1 / (1 + 10**(d / 400)) for d in range(-MAX_RATING_DIFF, MAX_RATING_DIFF + 1)]
+
+def elo_delta(winner_rating, loser_rating, winner_score, loser_score):
+    """Calculates the whole-point ELO change for a best-of-3 match result."""
     K_BASE = 32
-    k_multiplier = 1.0
+    K = K_BASE
     if winner_score == 2 and loser_score == 0:
-        k_multiplier = 1.5
+        K = K_BASE * 3 // 2  # 2-0 shutouts count 1.5x
     
-    K = K_BASE * k_multiplier
-    prob_winner = 1 / (1 + 10**((loser_rating - winner_rating) / 400))
-    rating_change = K * (1 - prob_winner)
-    
-    return winner_rating + rating_change, loser_rating - rating_change
+    rating_diff = max(-MAX_RATING_DIFF, min(MAX_RATING_DIFF, loser_rating - winner_rating))
+    prob_winner = EXPECTED_SCORE[rating_diff + MAX_RATING_DIFF]
+    return round(K * (1 - prob_winner))
 
 # --- API Endpoints ---
+def with_state_lock(view):
+    """Runs a view while holding the state lock, so each request sees and leaves consistent state."""
+    @wraps(view)
+    def locked_view(*args, **kwargs):
+        with _state_lock:
+            init_storage()
+            return view(*args, **kwargs)
+    return locked_view
+
 @app.route('/')
 def index():
     """Serves the main HTML file."""
     return render_template('table--matcher.html')
 
 @app.route('/api/session', methods=['GET'])
+@with_state_lock
 def get_session():
     """Endpoint to get the current session state."""
     return jsonify(get_session_state())
 
 @app.route('/api/players', methods=['GET'])
+@with_state_lock
 def get_players():
     """Endpoint to get the list of all players."""
     return jsonify(get_players_from_csv())
 
 @app.route('/api/players', methods=['POST'])
+@with_state_lock
 def add_player():
     """Endpoint to add a new player. Now works mid-session."""
     data = request.json
     if not data or 'name' not in data or not data['name'].strip():
         return jsonify({"error": "Player name is required"}), 400
     
-    players = get_players_from_csv()
-    new_player = {
-        'id': get_next_player_id(players),
-        'name': data['name'].strip(),
-        'elo': STARTING_ELO,
-        'wins': 0,
-        'losses': 0,
-        'is_playing': True
-    }
-    players.append(new_player)
-    write_players_to_csv(players)
+    new_player = Player(get_next_player_id(), data['name'].strip())
+    _players_cache[new_player.id] = new_player
+    _schedule_write()
 
     if session_data['is_active']:
-        session_data['players'][new_player['id']] = new_player
-        session_data['waiting_ids'].append(new_player['id'])
-        session_data['waiting_ids'].sort(key=lambda pid: session_data['players'][pid]['elo'], reverse=True)
+        session_data['players'][new_player.id] = new_player
+        enqueue_player(new_player)
         fill_empty_tables()
     
     return jsonify(new_player), 201
 
 @app.route('/api/players/<player_id>', methods=['DELETE'])
+@with_state_lock
 def delete_player(player_id):
     """Endpoint to delete a player."""
-    players = get_players_from_csv()
-    players_to_keep = [p for p in players if p['id'] != player_id]
-    
-    if len(players) == len(players_to_keep):
+    if _players_cache.pop(player_id, None) is None:
         return jsonify({"error": "Player not found"}), 404
         
-    write_players_to_csv(players_to_keep)
+    _schedule_write()
     return jsonify({"message": "Player deleted"}), 200
 
 @app.route('/api/players/toggle', methods=['POST'])
+@with_state_lock
 def toggle_player_status():
     """Endpoint to toggle a player's is_playing status. Now works mid-session."""
     data = request.json
     player_id = str(data.get('id'))
     
-    players = get_players_from_csv()
-    player_found = False
-    for p in players:
-        if p['id'] == player_id:
-            p['is_playing'] = not p['is_playing']
-            player_found = True
-            
-            if session_data['is_active'] and not p['is_playing']:
-                if player_id in session_data['players']:
-                    del session_data['players'][player_id]
-                session_data['waiting_ids'] = [pid for pid in session_data['waiting_ids'] if pid != player_id]
-            break
-            
-    if not player_found:
+    p = _players_cache.get(player_id)
+    if p is None:
         return jsonify({"error": "Player not found"}), 404
 
-    write_players_to_csv(players)
+    p.is_playing = not p.is_playing
+    if session_data['is_active'] and not p.is_playing:
+        session_data['players'].pop(player_id, None)
+        dequeue_player(p)
+
+    _schedule_write()
     return jsonify({"message": "Player status updated"}), 200
 
 @app.route('/api/session/start', methods=['POST'])
+@with_state_lock
 def start_session():
     """Endpoint to start a new match session."""
     data = request.json
     session_data['max_tables'] = data.get('tableCount', 1)
     
-    all_players = get_players_from_csv()
-    players_for_session = [p for p in all_players if p['is_playing']]
+    players_for_session = [p for p in _players_cache.values() if p.is_playing]
     
     if len(players_for_session) < 2:
         return jsonify({"error": "Need at least 2 active players"}), 400
 
     session_data['is_active'] = True
-    session_data['players'] = {p['id']: p for p in players_for_session}
-    session_data['waiting_ids'] = sorted([p['id'] for p in players_for_session], key=lambda pid: session_data['players'][pid]['elo'], reverse=True)
-    session_data['active_matches'] = []
+    session_data['players'] = {p.id: p for p in players_for_session}
+    session_data['waiting_queue'] = sorted((-p.elo, p.id) for p in players_for_session)
+    session_data['active_matches'] = {}
     
     fill_empty_tables()
     return jsonify(get_session_state())
 
+def enqueue_player(player):
+    """Inserts a player into the waiting queue, keeping it ordered by ELO."""
+    bisect.insort(session_data['waiting_queue'], (-player.elo, player.id))
+
+def dequeue_player(player):
+    """Removes a player from the waiting queue, returning whether they were in it."""
+    queue = session_data['waiting_queue']
+    entry = (-player.elo, player.id)
+    i = bisect.bisect_left(queue, entry)
+    if i < len(queue) and queue[i] == entry:
+        del queue[i]
+        return True
+    return False
+
 def fill_empty_tables():
     """Internal logic to create new matches from the queue."""
-    while len(session_data['active_matches']) < session_data['max_tables'] and len(session_data['waiting_ids']) >= 2:
-        p1_id = session_data['waiting_ids'].pop(0)
-        p2_id = session_data['waiting_ids'].pop(0)
-        session_data['active_matches'].append({
-            "id": f"match-{p1_id}-{p2_id}",
+    while len(session_data['active_matches']) < session_data['max_tables'] and len(session_data['waiting_queue']) >= 2:
+        _, p1_id = session_data['waiting_queue'].pop(0)
+        _, p2_id = session_data['waiting_queue'].pop(0)
+        match_id = f"match-{p1_id}-{p2_id}"
+        session_data['active_matches'][match_id] = {
+            "id": match_id,
             "player1Id": p1_id,
-            "player2Id": p2_id
-        })
+            "player2Id": p2_id,
+            "player1": session_data['players'][p1_id],
+            "player2": session_data['players'][p2_id]
+        }
 
 @app.route('/api/session/end', methods=['POST'])
+@with_state_lock
 def end_session():
     """Endpoint to end the current session."""
+    flush_players()
     session_data.update({
-        "is_active": False, "players": {}, "waiting_ids": [], 
-        "active_matches": [], "max_tables": 0
+        "is_active": False, "players": {}, "waiting_queue": [], 
+        "active_matches": {}, "max_tables": 0
     })
     return jsonify({"message": "Session ended"})
 
 @app.route('/api/session/record', methods=['POST'])
+@with_state_lock
 def record_result():
     """Endpoint to record a match result and generate a new match."""
     data = request.json
     winner_id = str(data['winnerId'])
     loser_id = str(data['loserId'])
 
-    all_players = get_players_from_csv()
-    winner = next((p for p in all_players if p['id'] == winner_id), None)
-    loser = next((p for p in all_players if p['id'] == loser_id), None)
+    winner = _players_cache.get(winner_id)
+    loser = _players_cache.get(loser_id)
 
     if not winner or not loser:
         return jsonify({"error": "Winner or loser not found in master list"}), 404
 
-    new_winner_rating, new_loser_rating = calculate_new_ratings(
-        winner['elo'], loser['elo'], data['winnerScore'], data['loserScore']
-    )
-    winner['elo'] = round(new_winner_rating)
-    winner['wins'] += 1
-    loser['elo'] = round(new_loser_rating)
-    loser['losses'] += 1
-    write_players_to_csv(all_players)
+    # Queue entries are keyed by ELO, so pull out any waiting player before their rating changes
+    requeue = []
+    if session_data['is_active']:
+        requeue = [p for p in (winner, loser) if dequeue_player(p)]
+
+    rating_change = elo_delta(winner.elo, loser.elo, data['winnerScore'], data['loserScore'])
+    winner.elo += rating_change
+    winner.wins += 1
+    loser.elo -= rating_change
+    loser.losses += 1
+    _schedule_write()
 
+    # Session players share the cached Player objects, so ELO and W/L are already current
     if session_data['is_active']:
-        session_data['players'][winner_id]['elo'] = winner['elo']
-        session_data['players'][winner_id]['wins'] += 1
-        session_data['players'][loser_id]['elo'] = loser['elo']
-        session_data['players'][loser_id]['losses'] += 1
-        
-        session_data['active_matches'] = [
-            m for m in session_data['active_matches'] 
-            if not ((m['player1Id'] == winner_id and m['player2Id'] == loser_id) or 
-                    (m['player1Id'] == loser_id and m['player2Id'] == winner_id))
-        ]
-
-        session_data['waiting_ids'].extend([winner_id, loser_id])
-        session_data['waiting_ids'].sort(key=lambda pid: session_data['players'][pid]['elo'], reverse=True)
+        # Match ids are derived from the pair, in whichever order they were drawn
+        active_matches = session_data['active_matches']
+        match = active_matches.pop(f"match-{winner_id}-{loser_id}", None)
+        if match is None:
+            match = active_matches.pop(f"match-{loser_id}-{winner_id}", None)
+        if match is not None:
+            requeue = [winner, loser]
+
+        # Players toggled off while at a table have left the session; don't re-queue them
+        for player in requeue:
+            if player.id in session_data['players']:
+                enqueue_player(player)
         
         fill_empty_tables()
     return jsonify(get_session_state())
@@ -244,19 +436,27 @@ def get_session_state():
     """Constructs the current session state to send to the frontend."""
     return {
         "isActive": session_data["is_active"],
-        "activeMatches": [{
-            **match,
-            'player1': session_data['players'].get(match['player1Id']),
-            'player2': session_data['players'].get(match['player2Id']),
-        } for match in session_data['active_matches']],
-        "waitingPlayers": [session_data['players'][pid] for pid in session_data['waiting_ids']]
+        "activeMatches": list(session_data['active_matches'].values()),
+        "waitingPlayers": [session_data['players'][pid] for _, pid in session_data['waiting_queue']]
     }
 
+def init_storage():
+    """Creates the CSV file if needed, loads players and starts the flusher, once per process."""
+    global _storage_ready
+    with _state_lock:
+        if _storage_ready:
+            return
+        if not os.path.exists(PLAYERS_CSV_FILE):
+            with open(PLAYERS_CSV_FILE, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
+                writer.writeheader()
+        load_players()
+        start_flusher()
+        _storage_ready = True
+
 if __name__ == '__main__':
-    if not os.path.exists(PLAYERS_CSV_FILE):
-        with open(PLAYERS_CSV_FILE, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-            writer.writeheader()
-    
-    app.run(debug=True, port=5001)
+    # Load up front so a bad CSV fails at startup; under WSGI servers the first API request loads it
+    init_storage()
+    # Debug mode (reloader, debugger) is opt-in via FLASK_DEBUG=1
+    app.run(port=5001)
 
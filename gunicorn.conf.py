@@ -0,0 +1,8 @@
+# Production server config: gunicorn -c gunicorn.conf.py TTMatcher:app
+# The session and player cache live in process memory, so run a single
+# worker and serve requests concurrently with threads instead.
+bind = '127.0.0.1:5001'
+workers = 1
+worker_class = 'gthread'
+threads = 8
+preload_app = False  # players load and the CSV flusher starts in the worker on the first request